@@ -1,11 +1,16 @@
 import os
+import re
+import hmac
 import logging
 import asyncio
 from pathlib import Path
 from datetime import datetime
+from dataclasses import dataclass
 
+import orjson
 from aiohttp import web
 from telethon import TelegramClient, errors as telethon_errors
+from telethon.sessions import SQLiteSession, StringSession
 
 from telegram import Update
 from telegram.ext import (
@@ -15,19 +20,33 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
+    BaseUpdateProcessor,
 )
+from telegram.request import HTTPXRequest
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 API_ID = os.environ.get("API_ID")
 API_HASH = os.environ.get("API_HASH")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+# optional; when set, Telegram sends it back in X-Telegram-Bot-Api-Secret-Token and requests without it are rejected
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
 PORT = int(os.environ.get("PORT", 5000))
 DELETE_AFTER_SEND = os.environ.get("DELETE_AFTER_SEND", "false").lower() in ("1", "true", "yes")
 
 if not BOT_TOKEN or not API_ID or not API_HASH or not WEBHOOK_URL:
     raise SystemExit("Missing required env vars: BOT_TOKEN, API_ID, API_HASH, WEBHOOK_URL")
 
+try:
+    API_ID = int(API_ID)
+except ValueError:
+    raise SystemExit("API_ID must be an integer")
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -38,44 +57,112 @@ logger = logging.getLogger("sessiongen")
 ASK_PHONE, WAIT_CODE, WAIT_2FA = range(3)
 
 
+# ---------------- LOGIN STATE ----------------
+@dataclass
+class LoginState:
+    """Per-user login progress, stored in context.user_data["state"]."""
+    phone: str
+    client: TelegramClient
+    session_path: Path
+
+
+# cap concurrent login-code requests (connect + send_code_request) per process; handlers for
+# different users run in parallel (see PerUserUpdateProcessor), so a burst of /gensession can
+# reach this. The slot is released once the code is sent, so it does not bound open clients.
+_LOGIN_SEM = asyncio.Semaphore(16)
+
+
 # ---------------- HELPERS ----------------
+# characters stripped from phone numbers when building session filenames
+_PHONE_STRIP = str.maketrans("", "", " -\t")
+# international format after stripping: + followed by 7-15 digits (E.164)
+_PHONE_RE = re.compile(r"^\+[0-9]{7,15}$")
+
+
 def make_session_filename(phone: str) -> Path:
     """Return a Path for the session file, based on the phone number."""
-    sanitized = phone.replace(" ", "").replace("-", "")
-    # ensure filename is safe; Telethon will create both .session and .session-journal etc
-    return Path(f"{sanitized}.session")
+    # ensure filename is safe; write_session_file creates this file once login succeeds
+    return Path(f"{phone.translate(_PHONE_STRIP)}.session")
+
+
+def write_session_file(session, path: Path):
+    """Materialize an in-memory Telethon session as a SQLite .session file."""
+    sqlite = SQLiteSession(str(path))
+    try:
+        sqlite.set_dc(session.dc_id, session.server_address, session.port)
+        sqlite.auth_key = session.auth_key
+        sqlite.save()
+    finally:
+        sqlite.close()
+
+
+def remove_session_files(path: Path):
+    """Delete the session file and any sqlite side files (-journal, -wal, ...) in one directory pass."""
+    prefix = path.name
+    with os.scandir(path.parent) as it:
+        for entry in it:
+            if entry.name.startswith(prefix):
+                os.unlink(entry.path)
 
 
 async def safe_send_file(bot, chat_id: int, path: Path, caption=""):
     """Send file and optionally delete afterwards."""
-    if not path.exists():
+    if not await asyncio.to_thread(path.exists):
         await bot.send_message(chat_id=chat_id, text="❌ Session file not found.")
         return
     try:
-        # open in binary mode
-        with path.open("rb") as f:
-            await bot.send_document(chat_id=chat_id, document=f, caption=caption)
+        # read the whole file off the event loop; session files are small so one buffered read is enough
+        data = await asyncio.to_thread(path.read_bytes)
+        await bot.send_document(chat_id=chat_id, document=data, filename=path.name, caption=caption)
     except Exception as e:
         logger.exception("Failed to send session file: %s", e)
         await bot.send_message(chat_id=chat_id, text="❌ Failed to send session file.")
         return
 
     if DELETE_AFTER_SEND:
-        # remove session file and any related -journal if present
         try:
-            path.unlink(missing_ok=True)
+            await asyncio.to_thread(remove_session_files, path)
         except Exception as e:
             logger.warning("Could not delete file %s: %s", path, e)
-        # telethon may create additional files like .session-journal; attempt to remove common suffixes
-        journal = path.with_name(path.name + "-journal")
-        try:
-            if journal.exists():
-                journal.unlink()
-        except Exception:
-            pass
         logger.info("Deleted local session file %s", path)
 
 
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across users, but one at a time per (chat, user).
+
+    The ConversationHandler only records a user's new state after a callback returns,
+    so two updates from the same user must not run in parallel.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting on it]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        if chat is None and user is None:
+            await coroutine
+            return
+        key = (chat.id if chat else None, user.id if user else None)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
 # ---------------- HANDLERS ----------------
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -87,39 +174,43 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❎ Cancelled.")
     # cleanup any partially created client
-    client = context.user_data.get("client")
+    state = context.user_data.get("state")
     try:
-        if client:
-            await client.disconnect()
+        if state:
+            await state.client.disconnect()
     except Exception:
         pass
     context.user_data.clear()
     return ConversationHandler.END
 
 
+async def idle_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /cancel outside a conversation: nothing to tear down
+    await update.message.reply_text("ℹ️ Nothing to cancel.")
+
+
 async def gensession_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📱 Send your phone number in international format (e.g. +919876543210).")
     return ASK_PHONE
 
 
 async def receive_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    phone = (update.message.text or "").strip()
-    if not phone or not phone.startswith("+") or len(phone) < 7:
+    phone = (update.message.text or "").strip().translate(_PHONE_STRIP)
+    if not _PHONE_RE.match(phone):
         await update.message.reply_text("⚠️ Invalid phone. Send again starting with +countrycode.")
         return ASK_PHONE
 
     session_path = make_session_filename(phone)
-    # Telethon expects a string path or a Session instance
-    client = TelegramClient(str(session_path), int(API_ID), API_HASH)
+    # keep the session in memory during login; it is written to session_path only once signed in
+    client = TelegramClient(StringSession(), API_ID, API_HASH)
 
-    context.user_data["phone"] = phone
-    context.user_data["client"] = client
-    context.user_data["session_path"] = session_path
+    context.user_data["state"] = LoginState(phone, client, session_path)
 
     await update.message.reply_text("🔄 Sending login code to Telegram...")
     try:
-        await client.connect()
-        await client.send_code_request(phone)
+        async with _LOGIN_SEM:
+            await client.connect()
+            await client.send_code_request(phone)
         await update.message.reply_text("✉️ Code sent! Please enter the code you received.")
         return WAIT_CODE
     except telethon_errors.PhoneNumberInvalidError:
@@ -143,26 +234,24 @@ async def receive_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def receive_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     code = (update.message.text or "").strip()
-    client: TelegramClient = context.user_data.get("client")
-    phone = context.user_data.get("phone")
-    session_path: Path = context.user_data.get("session_path")
+    state: LoginState = context.user_data.get("state")
 
-    if client is None or phone is None or session_path is None:
+    if state is None:
         await update.message.reply_text("⚠️ Session expired or internal error. Start again with /gensession.")
         context.user_data.clear()
         return ConversationHandler.END
+    client = state.client
 
     try:
-        await client.sign_in(phone=phone, code=code)
+        await client.sign_in(phone=state.phone, code=code)
         await update.message.reply_text("✅ Signed in successfully! Preparing session file...")
         try:
             await client.disconnect()
         except Exception:
             pass
 
-        # Telethon created the session file on disk at session_path (string passed earlier)
-        # send the .session file (and related files)
-        await safe_send_file(context.bot, update.effective_chat.id, session_path, caption="Here is your session file.")
+        await asyncio.to_thread(write_session_file, client.session, state.session_path)
+        await safe_send_file(context.bot, update.effective_chat.id, state.session_path, caption="Here is your session file.")
         context.user_data.clear()
         return ConversationHandler.END
 
@@ -187,13 +276,13 @@ async def receive_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def receive_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = (update.message.text or "").strip()
-    client: TelegramClient = context.user_data.get("client")
-    session_path: Path = context.user_data.get("session_path")
+    state: LoginState = context.user_data.get("state")
 
-    if client is None or session_path is None:
+    if state is None:
         await update.message.reply_text("⚠️ Session expired or internal error. Start again with /gensession.")
         context.user_data.clear()
         return ConversationHandler.END
+    client = state.client
 
     try:
         await client.sign_in(password=password)
@@ -202,7 +291,8 @@ async def receive_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await client.disconnect()
         except Exception:
             pass
-        await safe_send_file(context.bot, update.effective_chat.id, session_path, caption="Here is your session file.")
+        await asyncio.to_thread(write_session_file, client.session, state.session_path)
+        await safe_send_file(context.bot, update.effective_chat.id, state.session_path, caption="Here is your session file.")
     except telethon_errors.SessionPasswordNeededError:
         await update.message.reply_text("❌ Password incorrect. Try again or /cancel.")
     except Exception as e:
@@ -220,7 +310,23 @@ async def receive_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------------- WEBHOOK SERVER ----------------
 def setup_application():
     # Build application normally. JobQueue extras aren't required; avoid conversation_timeout to skip JobQueue warning.
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Outbound pool is sized for concurrent conversations and uses HTTP/2 so sends multiplex over one connection;
+    # getUpdates is unused in webhook mode so keep it minimal.
+    request = HTTPXRequest(
+        connection_pool_size=32,
+        pool_timeout=10.0,
+        connect_timeout=10.0,
+        read_timeout=30.0,
+        http_version="2",
+    )
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_connection_pool_size(1)
+        .concurrent_updates(PerUserUpdateProcessor(64))
+        .build()
+    )
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("gensession", gensession_start)],
@@ -235,15 +341,34 @@ def setup_application():
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(conv)
-    app.add_handler(CommandHandler("cancel", cancel_cmd))
+    app.add_handler(CommandHandler("cancel", idle_cancel_cmd))
     return app
 
 
 async def webhook_handler(request: web.Request):
+    # reject probes and junk before touching the body
+    # compare bytes: compare_digest rejects non-ASCII str arguments with TypeError, and aiohttp
+    # decodes invalid UTF-8 header bytes as surrogates, so encode them back the same way
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8", "surrogateescape"),
+        WEBHOOK_SECRET.encode(),
+    ):
+        return web.Response(status=403)
+    if request.content_type != "application/json":
+        return web.Response(status=415)
+
     app = request.app["telegram_app"]
-    data = await request.json()
-    update = Update.de_json(data, app.bot)
-    await app.process_update(update)
+    try:
+        data = orjson.loads(await request.read())
+        update = Update.de_json(data, app.bot)
+    except (orjson.JSONDecodeError, TypeError, ValueError):
+        return web.Response(status=400)
+    # de_json returns None for empty payloads such as null, {} or []
+    if update is None:
+        return web.Response(status=400)
+    # ack immediately so slow Telethon calls don't make Telegram retry the delivery;
+    # PerUserUpdateProcessor runs different users concurrently and each user's updates in order
+    await app.update_queue.put(update)
     return web.Response(status=200)
 
 
@@ -251,34 +376,43 @@ async def health_check(request: web.Request):
     return web.Response(text="OK", status=200)
 
 
-async def set_webhook():
-    from telegram import Bot
-    bot = Bot(token=BOT_TOKEN)
-    await bot.set_webhook(WEBHOOK_URL)
+async def set_webhook(bot):
+    # reuse the application's bot so the webhook call shares its HTTPX pool
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
     logger.info("Webhook set to %s", WEBHOOK_URL)
 
 
 async def main():
     telegram_app = setup_application()
-    web_app = web.Application()
+    # Telegram updates are far below 1MB; this only makes aiohttp's default body limit explicit
+    web_app = web.Application(client_max_size=1024 * 1024)
     web_app["telegram_app"] = telegram_app
     web_app.router.add_post("/", webhook_handler)
     web_app.router.add_get("/health", health_check)
 
-    await set_webhook()
+    await telegram_app.initialize()
+    await set_webhook(telegram_app.bot)
+
+    await telegram_app.start()
 
     runner = web.AppRunner(web_app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
 
-    await telegram_app.initialize()
     logger.info("Bot is running on port %s", PORT)
 
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await telegram_app.stop()
+        await telegram_app.shutdown()
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     try:
         asyncio.run(main())
     except KeyboardInterrupt: